@@ -0,0 +1,57 @@
+'''
+This module contains a compiled kernel for Fisher's Exact Test
+on very large co-occurrence matrices. It requires Numba; 
+significance.py falls back on its NumPy version without it.
+'''
+
+import math
+from numba import njit, prange
+
+@njit(cache=True)
+def _two_sided_p_2x2(a, b, c, d, logfact):
+    """Calculate two-sided Fisher's p-value of one 2x2 table.
+
+    Sums the hypergeometric probability of every value of A
+    that is no more likely than the observed one, using
+    log-factorials to keep the terms in range.
+    """
+    total = a + b + c + d
+    succ = a + b
+    draws = a + c
+    x_min = max(0, draws - (total - succ))
+    x_max = min(succ, draws)
+
+    # log of the terms shared by every pmf in this table
+    shared = (
+        logfact[succ] + logfact[total - succ] + logfact[draws] 
+        + logfact[total - draws] - logfact[total]
+    )
+
+    def logpmf(x):
+        return shared - (
+            logfact[x] + logfact[succ - x] + logfact[draws - x]
+            + logfact[total - succ - draws + x]
+        )
+
+    # relative tolerance for ties in probability, as in R
+    threshold = logpmf(a) + math.log1p(1e-7)
+    p_value = 0.0
+    for x in range(x_min, x_max + 1):
+        logp = logpmf(x)
+        if logp <= threshold:
+            p_value += math.exp(logp)
+    return min(p_value, 1.0)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def fishers_p(a, b, c, d, logfact, out):
+    """Calculate two-sided Fisher's p-values of many 2x2 tables.
+
+    Args:
+        a, b, c, d: 1-D int64 arrays with the contingency 
+            counts of each table
+        logfact: 1-D float64 array of log(k!) for k up to
+            the largest table total
+        out: 1-D float64 array to write the p-values to
+    """
+    for i in prange(a.size):
+        out[i] = _two_sided_p_2x2(a[i], b[i], c[i], d[i], logfact)
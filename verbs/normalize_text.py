@@ -5,17 +5,73 @@ This should later be turned into a separate
 TF feature.
 """
 
-import re
 import unicodedata
 
+# combining accents stripped from decomposed text
+_ACCENTS = '\u0300\u0301\u0304\u0306\u0308\u0303'
+_STRIP = str.maketrans('', '', _ACCENTS)
+_SEP = '\x1f'
+
+def _normalize(norm):
+    """Strip accents from a plain text string."""
+    if norm.isascii(): # no accents to strip
+        return norm
+    norm = unicodedata.normalize('NFD', norm) # decompose for accent stripping
+    norm = norm.translate(_STRIP) # strip accents
+    return unicodedata.normalize('NFC', norm)
+
+def make_normalizer(tf):
+    """Build a normalize function bound to a corpus.
+
+    The feature lookups are resolved once, so the returned
+    function is cheap to call on every word in a corpus, e.g.:
+
+        >> norm = make_normalizer(tf)
+        >> [norm(w) for w in words]
+    
+    Args:
+        tf: an instance of Text-Fabric with a loaded corpus
+
+    Returns:
+        function that takes a word node and returns its
+        normalized text
+    """
+    text_v = tf.F.text.v
+    end_v = tf.F.end.v
+
+    def normalize_word(word):
+        return _normalize(text_v(word).replace(end_v(word),''))
+
+    return normalize_word
+
 def normalize_nena(word, tf):
     """Strip accents and spaces from NENA text on a node.
     
     Args:
         word: a node number to get normalized text
     """
-    accents = '\u0300|\u0301|\u0304|\u0306|\u0308|\u0303'
-    norm = tf.F.text.v(word).replace(tf.F.end.v(word),'')
-    norm = unicodedata.normalize('NFD', norm) # decompose for accent stripping
-    norm = re.sub(accents, '', norm) # strip accents
-    return unicodedata.normalize('NFC', norm)
+    return _normalize(tf.F.text.v(word).replace(tf.F.end.v(word),''))
+
+def normalize_nena_many(words, tf):
+    """Strip accents and spaces from NENA text on many nodes.
+
+    Same result as calling normalize_nena on each node, but 
+    the texts are joined with a separator (ASCII unit separator,
+    which never combines with accents) and normalized in one go, 
+    then split again.
+
+    Args:
+        words: an iterable of word nodes
+        tf: an instance of Text-Fabric with a loaded corpus
+
+    Returns:
+        list of normalized texts in the order of words
+    """
+    text_v = tf.F.text.v
+    end_v = tf.F.end.v
+    words = list(words)
+    if not words:
+        return []
+    raw = _SEP.join(text_v(w).replace(end_v(w),'') for w in words)
+    norm = unicodedata.normalize('NFD', raw).translate(_STRIP)
+    return unicodedata.normalize('NFC', norm).split(_SEP)
@@ -1,3 +1,5 @@
+import array
+
 class Positions:
     """Access positions around a node in a context.
     
@@ -5,7 +7,7 @@ class Positions:
     that is (+/-)N positions away in a context.
     """
     
-    def __init__(self, element, positions, default=None):
+    def __init__(self, element, positions, default=None, originindex=None):
         """Prepare context and positions for a supplied TF node.
         
         Arguments:
@@ -16,14 +18,56 @@ class Positions:
             tf: an instance of Text-Fabric with a loaded corpus.
             order: The method of order to use for the search.
                 Options are "slot" or "node."
+            originindex: index of element in positions, if
+                already known; saves searching for it.
         """
     
         # set up elements and positions
         self.element = element
         self.positions = positions
-        self.originindex = self.positions.index(element)
+        self._n = len(positions)
+        if originindex is None:
+            originindex = self.positions.index(element)
+        self.originindex = originindex
         self.default = default
+
+    @classmethod
+    def from_context(cls, positions):
+        """Make Positions for many elements of one context.
+        
+        The index of every element is computed once, so 
+        that walking a whole context is linear rather than 
+        quadratic, and the nodes are stored once as a compact 
+        int64 array shared by every Positions made, e.g.:
+
+            > P = Positions.from_context(L.d(context, 'word'))
+            > [P(word).get(1) for word in L.d(context, 'word')]
+        
+        Arguments:
+            positions: an iterable of the ordered nodes 
+                of the context.
+
+        Returns:
+            function that takes an element and optional default
+            and returns a Positions object for it
+        """
+        positions = array.array('q', positions)
+        indices = {node: i for i, node in enumerate(positions)}
+
+        def make_positions(element, default=None):
+            try:
+                originindex = indices[element]
+            except KeyError:
+                # match the error of positions.index in __init__
+                raise ValueError(f'{element} is not in positions') from None
+            return cls(element, positions, default, originindex)
+
+        return make_positions
     
+    def as_list(self):
+        """Get the context nodes as a list."""
+        return list(self.positions)
+
     def elementpos(self, position):
         """Get position using order of context.
         
@@ -49,11 +93,9 @@ class Positions:
         # use index in positions to get adjacent node
         # return None when exceeding bounds of context
         pos_index = self.originindex + position
-        pos_index = pos_index if (pos_index > -1) else None
-        try:
+        if 0 <= pos_index < self._n:
             return self.positions[pos_index]
-        except (IndexError, TypeError):
-            return None
+        return None
 
     def get(self, position, default=None, do=None):
         """Get data on node (+/-)N positions away. 
@@ -2,10 +2,18 @@
 This module contains scripts for testing statistical associations.
 '''
 
-import collections
+import functools
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
+from scipy.special import gammaln
+
+# largest support of A summed term by term in Fisher's test;
+# above it, tails come from hypergeom cdf/sf in O(log) steps
+SUMMED_SUPPORT_MAX = 300
+
+# largest grand total with a lookup table of log-factorials
+LOGFACT_TABLE_MAX = 2**22
 
 def contingency_table(df, sample_axis, feature_axis):
     """Build 2x2 contingency table for calculating association measures.
@@ -58,40 +66,286 @@ def contingency_table(df, sample_axis, feature_axis):
         5-tuple of dataframes as (a, b, c, d, e)
     """    
 
-    # put data in sample * feature format for calculations
-    # will flip it back at end if needed
-    if sample_axis == 1 and feature_axis == 0:
-        df = df.T
-    elif sample_axis != 0 and feature_axis != 1:
-        raise Exception('Invalid axis! Should be 0 or 1')
+    vals = _table_values(df)
+    b, c, d, e = _contingency_arrays(vals, sample_axis, feature_axis)
 
-    # get observation sums across samples / features
-    # fill each row in a column with the sum across the whole column
-    # and do same for columns
-    samp_margins = df.apply(
-        lambda row: row.sum(), 
-        axis=1, 
-        result_type='broadcast' # keeps same shape
-    ) 
-    feat_margins = df.apply(
-        lambda col: col.sum(), 
-        axis=0, 
-        result_type='broadcast'
-    ) 
-    total_margin = df.sum().sum()
-    b = samp_margins.sub(df) # NB "df" == a
-    c = feat_margins.sub(df)
-    # for d, make table where every cell is total margin
-    # use that table to make subtractions:
-    d = pd.DataFrame.copy(df, deep=True)
-    d[:] = total_margin 
-    d = d.sub(df+b+c)
-    e = samp_margins * feat_margins / total_margin
-    # flip axes back if needed:
-    if sample_axis == 1:
-        df,b,c,d,e = df.T, b.T, c.T, d.T, e.T
+    b, c, d, e = (
+        pd.DataFrame(x, index=df.index, columns=df.columns) 
+            for x in (b, c, d, e)
+    )
     return (df, b, c, d, e)
-    
+
+def _table_values(df):
+    """Get the values of a dataframe as a plain NumPy array.
+
+    Extension dtypes (e.g. pandas' nullable "Int64") are 
+    converted to their NumPy dtype, or to float with NaN 
+    where values are missing.
+    """
+    if not any(
+        isinstance(dtype, pd.api.extensions.ExtensionDtype) 
+            for dtype in df.dtypes
+    ):
+        return df.to_numpy()
+    dtype = np.result_type(*(
+        getattr(dtype, 'numpy_dtype', dtype) for dtype in df.dtypes
+    ))
+    if df.isna().to_numpy().any():
+        return df.to_numpy(dtype=np.result_type(dtype, float), na_value=np.nan)
+    return df.to_numpy(dtype=dtype)
+
+def _contingency_arrays(vals, sample_axis, feature_axis):
+    """Calculate B, C, D, E of contingency_table on an ndarray.
+
+    Works in the orientation of vals, summing along the given 
+    axes instead of transposing.
+
+    Returns:
+        4-tuple of arrays shaped like vals as (b, c, d, e)
+    """
+    if (sample_axis, feature_axis) not in ((0, 1), (1, 0)):
+        raise Exception('Invalid axis! Should be 0 or 1')
+
+    # get observation sums across samples / features as 
+    # vectors that broadcast against the table
+    samp_margins = vals.sum(axis=feature_axis, keepdims=True)
+    feat_margins = vals.sum(axis=sample_axis, keepdims=True)
+    total_margin = samp_margins.sum()
+    b = samp_margins - vals # NB "vals" == a
+    c = feat_margins - vals
+    # D and E are updated in place to avoid full-size temporaries
+    d = (total_margin - samp_margins) - feat_margins
+    d += vals # == total-(a+b+c)
+    e = np.multiply(samp_margins, feat_margins, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        e /= total_margin
+    return (b, c, d, e)
+
+def fishers_exact(a, b, c, d):
+    """Calculate two-sided Fisher's Exact Test on many 2x2 tables.
+
+    Vectorized equivalent of scipy.stats.fisher_exact for the
+    two-sided case. Each table is given as flat arrays of its
+    cells, following the layout in contingency_table:
+
+        >> [[a, b],
+        >>  [c, d]]
+
+    A is distributed hypergeometrically given the table's margins. 
+    The two-sided p-value sums the probabilities of all values of A
+    that are no more likely than the observed one (cf. Levshina 
+    2015, 232). Small tables sum these directly (with a compiled
+    kernel if Numba is installed); large ones take the tails from 
+    scipy's hypergeom cdf/sf.
+
+    Args:
+        a, b, c, d: 1-D integer arrays of equal length with the
+            contingency counts of each table
+
+    Returns:
+        2-tuple of arrays as (p-values, odds_ratios)
+    """
+    a, b, c, d = (np.asarray(x) for x in (a, b, c, d))
+    for x in (a, b, c, d):
+        if not (np.isfinite(x).all() and (x >= 0).all()):
+            raise ValueError('All values in table must be finite and nonnegative.')
+    a, b, c, d = (x.astype(np.int64, copy=False) for x in (a, b, c, d))
+
+    # odds ratio is inf when a cell on the anti-diagonal is 0,
+    # NaN when a whole row or column is 0 (as in scipy)
+    oddsratios = np.full(a.shape, np.inf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(a * d, b * c, out=oddsratios, where=(b > 0) & (c > 0))
+    empty = ((a + b) == 0) | ((c + d) == 0) | ((a + c) == 0) | ((b + d) == 0)
+    oddsratios[empty] = np.nan
+
+    # p is 1 by construction with an empty margin, or when A is at 
+    # the mode (no value is more likely); in sparse matrices this
+    # is most cells, so only test the rest
+    mode = (a + c + 1) * (a + b + 1) // (a + b + c + d + 2)
+    p_values = np.ones(a.shape)
+    test = np.flatnonzero(~empty & (a != mode))
+    if test.size:
+        p_values[test] = _two_sided_p(*(x[test] for x in (a, b, c, d)))
+
+    return (p_values, oddsratios)
+
+@functools.lru_cache(maxsize=None)
+def _numba_kernel():
+    """Get the optional compiled Fisher's kernel, or None.
+
+    Imported on first use, since loading Numba is slow.
+    """
+    try:
+        from _fishers_numba import fishers_p
+    except ImportError:
+        return None
+    return fishers_p
+
+def _log_factorials(n):
+    """Get table of log(k!) for k = 0..n, if small.
+
+    Returns None above LOGFACT_TABLE_MAX, where the log pmf
+    is computed without a table.
+    """
+    if n > LOGFACT_TABLE_MAX:
+        return None
+    return gammaln(np.arange(n + 1) + 1)
+
+def _two_sided_p(a, b, c, d):
+    """Calculate two-sided p-values for fishers_exact.
+
+    Tables where A has a small support sum the probability of 
+    each of its values, compiled with Numba if available. For 
+    a large support that sum is too slow; the cut-off on the 
+    opposite tail is found by binary search instead, and the 
+    tails come from scipy's hypergeom cdf/sf, as in
+    scipy.stats.fisher_exact.
+    """
+    a, b, c, d = (np.ascontiguousarray(x) for x in (a, b, c, d))
+    logfact = _log_factorials(int((a + b + c + d).max()))
+    support = np.minimum(a + b, a + c) - np.maximum(0, a - d) + 1
+    small = np.flatnonzero(support <= SUMMED_SUPPORT_MAX)
+    large = np.flatnonzero(support > SUMMED_SUPPORT_MAX)
+    p_values = np.empty(a.shape)
+
+    fishers_p = _numba_kernel() if small.size else None
+    if fishers_p is not None and logfact is not None:
+        tested = np.empty(small.size)
+        fishers_p(a[small], b[small], c[small], d[small], logfact, tested)
+        p_values[small] = tested
+    elif small.size:
+        p_values[small] = _summed_p(
+            a[small], b[small], c[small], d[small], logfact
+        )
+    if large.size:
+        p_values[large] = _tail_p(
+            a[large], b[large], c[large], d[large], logfact
+        )
+
+    return np.minimum(p_values, 1.0)
+
+def _hypergeom_logpmf(a, b, c, d, logfact):
+    """Build the log pmf of A given each table's margins.
+
+    Args:
+        a, b, c, d: 1-D int64 arrays of the tables
+        logfact: table from _log_factorials, or None to use
+            scipy's hypergeom.logpmf (more accurate for the
+            large log-factorials of a large total)
+
+    Returns:
+        function of (x, i) giving the log pmf at values x
+        for the tables at indices i
+    """
+    total = a + b + c + d
+    succ = a + b
+    draws = a + c
+    if logfact is None:
+        return lambda x, i: stats.hypergeom.logpmf(x, total[i], succ[i], draws[i])
+
+    lognorm = (
+        logfact[succ] + logfact[total - succ] + logfact[draws] 
+        + logfact[total - draws] - logfact[total]
+    )
+
+    def logpmf(x, i):
+        return lognorm[i] - (
+            logfact[x] + logfact[succ[i] - x] + logfact[draws[i] - x]
+            + logfact[total[i] - succ[i] - draws[i] + x]
+        )
+
+    return logpmf
+
+def _summed_p(a, b, c, d, logfact, chunk=2**22):
+    """Calculate two-sided p-values by summing over the support.
+
+    Every value of A in each table's support is expanded into 
+    one flat array, so that the sums run over all tables at 
+    once; tables are taken in chunks of about `chunk` values
+    to keep the expansion bounded.
+    """
+    logpmf = _hypergeom_logpmf(a, b, c, d, logfact)
+    x_min = np.maximum(0, a - d)
+    x_max = np.minimum(a + b, a + c)
+
+    # relative tolerance for ties in probability, as in R
+    threshold = logpmf(a, np.arange(a.size)) + np.log1p(1e-7)
+
+    # sum the probability of every value of A no more likely 
+    # than the observed one
+    sizes = x_max - x_min + 1
+    ends = np.cumsum(sizes)
+    p_values = np.empty(a.shape)
+    start = 0
+    while start < a.size:
+        done = ends[start - 1] if start else 0
+        stop = max(np.searchsorted(ends, done + chunk, side='right'), start + 1)
+        cells = np.arange(start, stop)
+        n = sizes[cells]
+        firsts = np.cumsum(n) - n
+        owner = np.repeat(cells, n)
+        x = x_min[owner] + np.arange(n.sum()) - np.repeat(firsts, n)
+        logp = logpmf(x, owner)
+        terms = np.where(logp <= threshold[owner], np.exp(logp), 0.0)
+        p_values[cells] = np.add.reduceat(terms, firsts)
+        start = stop
+
+    return p_values
+
+def _tail_p(a, b, c, d, logfact):
+    """Calculate two-sided p-values from hypergeometric tails.
+
+    The probabilities decrease away from the mode, so the 
+    cut-off on the opposite tail is found with a binary search 
+    that runs over all tables simultaneously.
+    """
+    logpmf = _hypergeom_logpmf(a, b, c, d, logfact)
+    total = a + b + c + d
+    succ = a + b
+    draws = a + c
+    x_min = np.maximum(0, a - d)
+    x_max = np.minimum(succ, draws)
+    mode = (draws + 1) * (succ + 1) // (total + 2)
+    p_values = np.ones(a.shape)
+
+    # relative tolerance for ties in probability, as in R
+    every = np.arange(a.size)
+    threshold = logpmf(a, every) + np.log1p(1e-7)
+    at_mode = logpmf(mode, every) <= threshold
+
+    # A below the mode: search upwards for first x with pmf <= pexact;
+    # x_max + 1 stands in for "no such x" and has an empty tail
+    lower = np.flatnonzero(~at_mode & (a < mode))
+    lo, hi = mode[lower] + 1, x_max[lower] + 1
+    while np.any(lo < hi):
+        mid = (lo + hi) // 2
+        ok = logpmf(np.minimum(mid, x_max[lower]), lower) <= threshold[lower]
+        active = lo < hi
+        hi = np.where(active & ok, mid, hi)
+        lo = np.where(active & ~ok, mid + 1, lo)
+    p_values[lower] = (
+        stats.hypergeom.cdf(a[lower], total[lower], succ[lower], draws[lower])
+        + stats.hypergeom.sf(hi - 1, total[lower], succ[lower], draws[lower])
+    )
+
+    # A above the mode: search downwards for last x with pmf <= pexact;
+    # x_min - 1 stands in for "no such x" and has an empty tail
+    upper = np.flatnonzero(~at_mode & (a > mode))
+    lo, hi = x_min[upper] - 1, mode[upper] - 1
+    while np.any(lo < hi):
+        mid = (lo + hi + 1) // 2
+        ok = logpmf(np.maximum(mid, x_min[upper]), upper) <= threshold[upper]
+        active = lo < hi
+        lo = np.where(active & ok, mid, lo)
+        hi = np.where(active & ~ok, mid - 1, hi)
+    p_values[upper] = (
+        stats.hypergeom.sf(a[upper] - 1, total[upper], succ[upper], draws[upper])
+        + stats.hypergeom.cdf(lo, total[upper], succ[upper], draws[upper])
+    )
+
+    return p_values
+
 def apply_fishers(df, sample_axis, feature_axis, logtransform=True):
     """Calculate Fisher's Exact Test with optional log10 transform.
 
@@ -115,47 +369,31 @@ def apply_fishers(df, sample_axis, feature_axis, logtransform=True):
         2-tuple of (p-values, odds_ratios) in DataFrames
     """
 
-    # put data in sample * feature format for calculations
-    # will flip it back at end if needed
-    if sample_axis == 1 and feature_axis == 0:
-        df = df.T
-    elif sample_axis != 0 and feature_axis != 1:
-        raise Exception('Invalid axis! Should be 0 or 1')
-    a_df, b_df, c_df, d_df, e_df = contingency_table(df, 0, 1)
-    ps = collections.defaultdict(lambda: collections.defaultdict())
-    odds = collections.defaultdict(lambda: collections.defaultdict())
-
-    # Calculate Fisher's value-by-value
-    # I'm not yet sure if there's a better way to do this
-    for sample in df.index:
-        for feature in df.columns: 
-
-            # exctract contingencies 
-            a = df[feature][sample]
-            b = b_df[feature][sample]
-            c = c_df[feature][sample]
-            d = d_df[feature][sample]
-            
-            # run Fisher's
-            contingency = np.matrix([[a, b], [c, d]])
-            oddsratio, p_value = stats.fisher_exact(contingency)
-            
-            # save and transform? scores
-            odds[feature][sample] = oddsratio
-            if not logtransform:
-                ps[feature][sample] = p_value
-            else:
-                expected_freq = e_df[feature][sample]
-                if a < expected_freq:
-                    with np.errstate(divide='ignore'):
-                        strength = np.log10(p_value)
-                else:
-                    with np.errstate(divide='ignore'):
-                        strength = -np.log10(p_value)
-                ps[feature][sample] = strength
-
-    # package into dfs, flip axis back if needed
-    orient = 'columns' if sample_axis == 0 else 'index' 
-    ps = pd.DataFrame.from_dict(ps, orient=orient)
-    odds = pd.DataFrame.from_dict(odds, orient=orient)
+    vals = _table_values(df)
+    b, c, d, e = _contingency_arrays(vals, sample_axis, feature_axis)
+
+    # Calculate Fisher's for all cells at once on flat arrays
+    a = vals.ravel()
+    p_values, oddsratios = fishers_exact(a, b.ravel(), c.ravel(), d.ravel())
+
+    # transform? scores; sign is negative (repulsion) when the
+    # observed frequency is lower than expected
+    if logtransform:
+        sign = np.where(a < e.ravel(), 1.0, -1.0)
+        strength = np.empty(p_values.shape)
+        with np.errstate(divide='ignore'):
+            np.log10(p_values, out=strength)
+        p_values = np.multiply(sign, strength, out=strength)
+
+    # package into dfs in the orientation of the input
+    ps = pd.DataFrame(
+        p_values.reshape(vals.shape),
+        index=df.index,
+        columns=df.columns,
+    )
+    odds = pd.DataFrame(
+        oddsratios.reshape(vals.shape),
+        index=df.index,
+        columns=df.columns,
+    )
     return (ps, odds)